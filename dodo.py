@@ -29,10 +29,12 @@ def _path_sortkey(p):
 
 def is_towncrier_fragment(path):
     parts = path.name.split(".")
+    # orphan fragments (not linked to an issue) use a "+" prefix
+    issue = parts[0][1:] if parts[0].startswith("+") else parts[0]
     return (
         len(parts) > 1
-        and parts[0].isdigit()
-        and parts[0].isascii()
+        and (issue.isdigit() or parts[0].startswith("+"))
+        and issue.isascii()
         and parts[1] in {"feature", "bugfix", "doc", "removal", "misc"}
     )
 
@@ -2,9 +2,21 @@
 # Copyright (c) 2019 Martijn Pieters
 # Licensed under the MIT license as detailed in LICENSE.txt
 
-from importlib.metadata import version  # type: ignore
+from typing import Any
 
 from .leakybucket import AsyncLimiter
 
-__version__ = version("aiolimiter")
+__version__: str  # set by __getattr__ on first access
 __all__ = ["AsyncLimiter"]
+
+
+def __getattr__(name: str) -> Any:
+    # __version__ is looked up from the package metadata on first access only,
+    # sparing every import the cost of importlib.metadata.
+    if name == "__version__":
+        from importlib.metadata import version
+
+        global __version__
+        __version__ = version("aiolimiter")
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -3,39 +3,48 @@
 # Licensed under the MIT license as detailed in LICENSE.txt
 
 import asyncio
+import math
 import os
 import sys
 import warnings
-from contextlib import AbstractAsyncContextManager
 from functools import partial
-from heapq import heappop, heappush
+from heapq import heapify, heappop, heappush
 from itertools import count
 from types import TracebackType
 from typing import List, Optional, Tuple, Type
 
+# Minimum number of cancelled waiters before compacting the waiters heap, and
+# the fraction of the heap that then has to be cancelled.
+_MIN_CANCELLED_WAITERS = 100
+_MIN_CANCELLED_WAITERS_FRACTION = 0.5
+
+# counter used to order waiting tasks with equal amounts; entries are only
+# ever compared within a single limiter's heap, so one counter serves all.
+_next_seq = partial(next, count())
+
 LIMITER_REUSED_ACROSS_LOOPS_WARNING = (
     "This AsyncLimiter instance is being re-used across loops. Please create "
     "a new limiter per event loop as re-use can lead to undefined behaviour."
 )
 
 if sys.version_info >= (3, 12):  # pragma: no cover
-    _warn_reuse = partial(
-        warnings.warn,
-        message=LIMITER_REUSED_ACROSS_LOOPS_WARNING,
-        category=RuntimeWarning,
-        skip_file_prefixes=(os.path.dirname(__file__),),
-    )
+    _SKIP_FILE_PREFIXES = (os.path.dirname(__file__),)
+
+    def _warn_reuse() -> None:
+        warnings.warn(
+            LIMITER_REUSED_ACROSS_LOOPS_WARNING,
+            RuntimeWarning,
+            skip_file_prefixes=_SKIP_FILE_PREFIXES,
+        )
+
 else:
-    # no support for dynamic stack levels, disable stack location
-    _warn_reuse = partial(
-        warnings.warn,
-        message=LIMITER_REUSED_ACROSS_LOOPS_WARNING,
-        category=RuntimeWarning,
-        stacklevel=0,
-    )
 
+    def _warn_reuse() -> None:
+        # no support for dynamic stack levels, disable stack location
+        warnings.warn(LIMITER_REUSED_ACROSS_LOOPS_WARNING, RuntimeWarning, stacklevel=0)
 
-class AsyncLimiter(AbstractAsyncContextManager):
+
+class AsyncLimiter:
     """A leaky bucket rate limiter.
 
     This is an :ref:`asynchronous context manager <async-context-managers>`;
@@ -59,11 +68,12 @@ class AsyncLimiter(AbstractAsyncContextManager):
         "max_rate",
         "time_period",
         "_rate_per_sec",
+        "_sec_per_unit",
         "_level",
         "_last_check",
         "_event_loop",
         "_waiters",
-        "_next_count",
+        "_cancelled_waiters",
         "_waker_handle",
     )
 
@@ -74,6 +84,8 @@ class AsyncLimiter(AbstractAsyncContextManager):
         self.max_rate = max_rate
         self.time_period = time_period
         self._rate_per_sec = max_rate / time_period
+        # a limiter with no capacity never drips out a unit
+        self._sec_per_unit = time_period / max_rate if max_rate else math.inf
         self._level = 0.0
         self._last_check = 0.0
 
@@ -81,8 +93,8 @@ class AsyncLimiter(AbstractAsyncContextManager):
         self._waker_handle: asyncio.TimerHandle | None = None
         # min-heap with (amount requested, order, future) for waiting tasks
         self._waiters: List[Tuple[float, int, "asyncio.Future[None]"]] = []
-        # counter used to order waiting tasks
-        self._next_count = partial(next, count())
+        # number of cancelled futures still in the waiters heap
+        self._cancelled_waiters = 0
 
     @property
     def _loop(self) -> asyncio.AbstractEventLoop:
@@ -99,21 +111,29 @@ class AsyncLimiter(AbstractAsyncContextManager):
                     for amt, cnt, fut in self._waiters
                     if fut.get_loop() == loop
                 ]
+                self._cancelled_waiters = 0
                 _warn_reuse()
 
         except AttributeError:
             loop = self._event_loop = asyncio.get_running_loop()
         return loop
 
-    def _leak(self) -> None:
-        """Drip out capacity from the bucket."""
-        now = self._loop.time()
-        if self._level:
-            # drip out enough level for the elapsed time since
-            # we last checked
-            elapsed = now - self._last_check
-            decrement = elapsed * self._rate_per_sec
-            self._level = max(self._level - decrement, 0)
+    def _leak(self, now: Optional[float] = None) -> None:
+        """Drip out capacity from the bucket.
+
+        :param now: The current loop time, if the caller already has it.
+
+        """
+        level = self._level
+        if not level:
+            # nothing to drip out; _last_check is reset when the level is
+            # next raised from empty.
+            return
+        if now is None:
+            now = self._loop.time()
+        # drip out enough level for the elapsed time since we last checked
+        decrement = (now - self._last_check) * self._rate_per_sec
+        self._level = level - decrement if level > decrement else 0.0
         self._last_check = now
 
     def has_capacity(self, amount: float = 1) -> bool:
@@ -140,46 +160,89 @@ class AsyncLimiter(AbstractAsyncContextManager):
             raise ValueError("Can't acquire more than the maximum capacity")
 
         loop = self._loop
-        while not self.has_capacity(amount):
-            # Add a future to the _waiters heapq to be notified when capacity
-            # has come up. The future callback uses call_soon so other tasks
-            # are checked *after* completing capacity acquisition in this task.
-            fut = loop.create_future()
-            fut.add_done_callback(partial(loop.call_soon, self._wake_next))
-            heappush(self._waiters, (amount, self._next_count(), fut))
-            self._wake_next()
-            await fut
-
-        self._level += amount
-        # reset the waker to account for the new, lower level.
+        if self.has_capacity(amount):
+            if not self._level:
+                # _leak() doesn't track time while the bucket is empty
+                self._last_check = loop.time()
+            self._level += amount
+            if self._waiters:
+                # reset the waker to account for the new, lower level.
+                self._wake_next()
+            return None
+
+        # Add a future to the _waiters heapq to be notified when capacity
+        # has come up; _wake_next reserves the capacity before waking us.
+        fut = loop.create_future()
+        fut.add_done_callback(self._schedule_wake)
+        heappush(self._waiters, (amount, _next_seq(), fut))
         self._wake_next()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                # cancelled after being woken; hand back the reserved capacity
+                self._level = max(self._level - amount, 0.0)
+                self._wake_next()
+            raise
 
         return None
 
+    def _schedule_wake(self, fut: "asyncio.Future[None]") -> None:
+        """Schedule a _wake_next call once a waiter is cancelled"""
+        if not fut.cancelled():
+            # woken by _wake_next, which carries on with the next waiter itself
+            return
+        # Cancelled waiters are only removed once they reach the top of
+        # the heap; drop them all at once if they start to pile up.
+        self._cancelled_waiters += 1
+        cancelled, heap = self._cancelled_waiters, self._waiters
+        if (
+            cancelled > _MIN_CANCELLED_WAITERS
+            and cancelled > len(heap) * _MIN_CANCELLED_WAITERS_FRACTION
+        ):
+            size = len(heap)
+            heap[:] = [entry for entry in heap if not entry[-1].done()]
+            heapify(heap)
+            # callbacks for some of the removed waiters may still be queued;
+            # they'll still increment the count when they run.
+            self._cancelled_waiters -= size - len(heap)
+        self._event_loop.call_soon(self._wake_next)
+
     def _wake_next(self, *_args: object) -> None:
-        """Wake the next waiting future or set a timer"""
-        # clear timer and any cancelled futures at the top of the heap
+        """Wake waiting futures while there is capacity, or set a timer"""
         heap, handle, self._waker_handle = self._waiters, self._waker_handle, None
         if handle is not None:
             handle.cancel()
-        while heap and heap[0][-1].done():
-            heappop(heap)
-
         if not heap:
             # nothing left waiting
             return
 
-        amount, _, fut = heap[0]
-        self._leak()
-        needed = amount - self.max_rate + self._level
-        if needed <= 0:
+        # only ever called once acquire() has bound the loop, so skip the
+        # reuse checks made by the _loop property.
+        loop = self._event_loop
+        now = loop.time()
+        self._leak(now)
+        # _leak() skips an empty bucket, but the level may be raised below
+        self._last_check = now
+
+        max_rate, level = self.max_rate, self._level
+        while heap:
+            amount, _, fut = heap[0]
+            if fut.done():
+                # cancelled waiter
+                heappop(heap)
+                self._cancelled_waiters -= 1
+                continue
+            needed = amount - max_rate + level
+            if needed > 0:
+                wake_next_at = now + self._sec_per_unit * needed
+                self._waker_handle = loop.call_at(wake_next_at, self._wake_next)
+                break
+            # reserve the capacity on behalf of the waiting task
             heappop(heap)
+            level += amount
             fut.set_result(None)
-            # fut.set_result triggers another _wake_next call
-            return
-
-        wake_next_at = self._last_check + (1 / self._rate_per_sec * needed)
-        self._waker_handle = self._loop.call_at(wake_next_at, self._wake_next)
+        self._level = level
 
     def __repr__(self) -> str:  # pragma: no cover
         args = f"max_rate={self.max_rate!r}, time_period={self.time_period!r}"
@@ -0,0 +1,29 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2019 Martijn Pieters
+# Licensed under the MIT license as detailed in LICENSE.txt
+
+import asyncio
+
+import pytest
+
+
+class MockLoopTime:
+    def __init__(self):
+        self.current_time = 0
+        self.loop = asyncio.get_running_loop()
+
+    def __enter__(self):
+        # shadow the loop.time() method with a plain closure; it is called on
+        # every loop iteration, so avoid the overhead of a mock object.
+        self.loop.time = lambda: self.current_time
+        return self
+
+    def __exit__(self, *_):
+        del self.loop.time
+
+
+@pytest.fixture
+async def mocked_time():
+    """Control the running loop's clock through ``mocked_time.current_time``"""
+    with MockLoopTime() as mocked_time:
+        yield mocked_time
@@ -3,15 +3,20 @@
 # Licensed under the MIT license as detailed in LICENSE.txt
 
 import asyncio
+import sys
+from contextlib import AbstractAsyncContextManager
 from pathlib import Path
-from unittest import mock
 
 import pytest
-import toml
 
 from aiolimiter import AsyncLimiter
 
-# max number of wait_for rounds when waiting for all events to settle
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import toml as tomllib
+
+# max loop iterations without progress when waiting for events to settle
 MAX_WAIT_FOR_ITER = 5
 
 
@@ -22,7 +27,7 @@ def test_version():
     assert __version__
 
     pyproject = Path(__file__).resolve().parent.parent / "pyproject.toml"
-    metadata = toml.load(pyproject)["tool"]["poetry"]
+    metadata = tomllib.loads(pyproject.read_text())["tool"]["poetry"]
 
     # pyproject bumps to -alpha.0, -beta.1, etc., but releases a0, b1
     # We don't really need to care about those, just verify that sorta
@@ -36,6 +41,16 @@ def test_attributes():
     assert limiter.time_period == 81
 
 
+def test_async_context_manager():
+    # not a base class, but the ABC recognises __aenter__ and __aexit__
+    assert isinstance(AsyncLimiter(1), AbstractAsyncContextManager)
+
+
+async def test_aexit_unused_limiter():
+    limiter = AsyncLimiter(1)
+    assert await limiter.__aexit__(None, None, None) is None
+
+
 async def test_has_capacity():
     limiter = AsyncLimiter(1)
     assert limiter.has_capacity()
@@ -45,6 +60,16 @@ async def test_has_capacity():
     assert not limiter.has_capacity()
 
 
+async def test_zero_capacity():
+    limiter = AsyncLimiter(0)
+    assert limiter.has_capacity(0)
+    assert not limiter.has_capacity()
+
+    await limiter.acquire(0)
+    with pytest.raises(ValueError):
+        await limiter.acquire()
+
+
 async def test_over_acquire():
     limiter = AsyncLimiter(1)
     with pytest.raises(ValueError):
@@ -62,124 +87,184 @@ async def async_contextmanager_task(limiter):
 
 async def wait_for_n_done(tasks, n):
     """Wait for n (or more) tasks to have completed"""
-    iteration = 0
+    # Completions are counted with done callbacks while the loop runs an
+    # iteration at a time. The loop clock is mocked, so a timeout would never
+    # expire; instead, give up after MAX_WAIT_FOR_ITER iterations in which no
+    # task completed. Waiting for 0 tasks lets the loop settle the same way.
     remainder = len(tasks) - n
-    pending_count = len(tasks)
-    while iteration <= MAX_WAIT_FOR_ITER:
-        iteration += 1
-        _, pending = await asyncio.wait(
-            tasks, timeout=0, return_when=asyncio.FIRST_COMPLETED
-        )
-        if len(pending) <= remainder:
+    pending = [task for task in tasks if not task.done()]
+    needed = len(pending) - remainder
+    if not pending or (n and needed <= 0):
+        # nothing left to wait for
+        return set(pending)
+
+    completed = idle = 0
+
+    def task_done(_task):
+        nonlocal completed, idle
+        completed += 1
+        idle = 0
+
+    for task in pending:
+        task.add_done_callback(task_done)
+    while idle <= MAX_WAIT_FOR_ITER:
+        idle += 1
+        await asyncio.sleep(0)
+        if n and completed >= needed:
             break
-        if len(pending) < pending_count:
-            iteration = 0
-            pending_count = len(pending)
+    for task in pending:
+        task.remove_done_callback(task_done)
+
+    pending = {task for task in pending if not task.done()}
     assert len(pending) <= remainder
     return pending
 
 
-class MockLoopTime:
-    def __init__(self):
-        self.current_time = 0
-        event_loop = asyncio.get_running_loop()
-        self.patch = mock.patch.object(event_loop, "time", self.mocked_time)
+@pytest.mark.parametrize("task", [acquire_task, async_contextmanager_task])
+async def test_acquire(task, mocked_time):
+    # capacity released every 2 seconds
+    limiter = AsyncLimiter(5, 10)
 
-    def mocked_time(self):
-        return self.current_time
+    tasks = [asyncio.create_task(task(limiter)) for _ in range(10)]
 
-    def __enter__(self):
-        self.patch.start()
-        return self
+    pending = await wait_for_n_done(tasks, 5)
+    assert len(pending) == 5
 
-    def __exit__(self, *_):
-        self.patch.stop()
+    mocked_time.current_time = 3  # releases capacity for one and some buffer
+    assert limiter.has_capacity()
 
+    pending = await wait_for_n_done(pending, 1)
+    assert len(pending) == 4
 
-@pytest.mark.parametrize("task", [acquire_task, async_contextmanager_task])
-async def test_acquire(task):
-    # capacity released every 2 seconds
-    limiter = AsyncLimiter(5, 10)
+    mocked_time.current_time = 7  # releases capacity for two more, plus buffer
+    pending = await wait_for_n_done(pending, 2)
+    assert len(pending) == 2
 
-    with MockLoopTime() as mocked_time:
-        tasks = [asyncio.ensure_future(task(limiter)) for _ in range(10)]
+    mocked_time.current_time = 11  # releases the remainder
+    pending = await wait_for_n_done(pending, 2)
+    assert len(pending) == 0
 
-        pending = await wait_for_n_done(tasks, 5)
-        assert len(pending) == 5
 
-        mocked_time.current_time = 3  # releases capacity for one and some buffer
-        assert limiter.has_capacity()
+async def test_acquire_wait_time(mocked_time):
+    limiter = AsyncLimiter(3, 3)
 
-        pending = await wait_for_n_done(pending, 1)
-        assert len(pending) == 4
+    # Fill the bucket with an amount of 1
+    await limiter.acquire(1)
 
-        mocked_time.current_time = 7  # releases capacity for two more, plus buffer
-        pending = await wait_for_n_done(pending, 2)
-        assert len(pending) == 2
+    # Acquiring an amount of 3 now should take 1 second
+    task = asyncio.create_task(limiter.acquire(3))
+    pending = await wait_for_n_done([task], 0)
+    assert pending
 
-        mocked_time.current_time = 11  # releases the remainder
-        pending = await wait_for_n_done(pending, 2)
-        assert len(pending) == 0
+    mocked_time.current_time = 1
+    pending = await wait_for_n_done([task], 1)
+    assert not pending
 
 
-async def test_acquire_wait_time():
+async def test_decreasing_acquire(mocked_time):
     limiter = AsyncLimiter(3, 3)
+    # Fill the bucket with an amount of 1
+    await limiter.acquire(1)
+
+    # Acquiring an amount of 3 would take 1 second
+    task = asyncio.create_task(limiter.acquire(3))
+    pending = await wait_for_n_done([task], 0)
+    assert pending
+
+    # _Unless_ a lower amount is acquired in-between
+    # increasing the wait time to 2 seconds
+    await limiter.acquire(1)
+
+    mocked_time.current_time = 1
+    pending = await wait_for_n_done([task], 0)
+    assert pending
 
-    with MockLoopTime() as mocked_time:
-        # Fill the bucket with an amount of 1
-        await limiter.acquire(1)
+    mocked_time.current_time = 2
+    pending = await wait_for_n_done([task], 1)
+    assert not pending
 
-        # Acquiring an amount of 3 now should take 1 second
-        task = asyncio.ensure_future(limiter.acquire(3))
-        pending = await wait_for_n_done([task], 0)
-        assert pending
 
-        mocked_time.current_time = 1
-        pending = await wait_for_n_done([task], 1)
-        assert not pending
+async def test_refill_after_idle(mocked_time):
+    limiter = AsyncLimiter(10, 10)
+    await limiter.acquire(10)
 
+    # fully drained, and stays empty while idle
+    mocked_time.current_time = 10
+    assert limiter.has_capacity(10)
+    mocked_time.current_time = 20
+    assert limiter.has_capacity(10)
 
-async def test_decreasing_acquire():
+    # refilling starts the drip from the moment of acquisition
+    await limiter.acquire(10)
+    mocked_time.current_time = 21
+    assert limiter.has_capacity(1)
+    assert not limiter.has_capacity(2)
+
+
+async def test_task_cancelled(mocked_time):
     limiter = AsyncLimiter(3, 3)
-    with MockLoopTime() as mocked_time:
-        # Fill the bucket with an amount of 1
-        await limiter.acquire(1)
+    # Fill the bucket with an amount of 1
+    await limiter.acquire(1)
+
+    # Two tasks asking for an amount of 3 would take 4 seconds
+    acquire = limiter.acquire
+    tasks = [asyncio.create_task(acquire(3)) for _ in range(2)]
+    pending = await wait_for_n_done(tasks, 0)
+    assert pending
+
+    # But if the first one is cancelled, it should only take 1 second for
+    # the second to finish
+    tasks[0].cancel()
+    mocked_time.current_time = 1
+    pending = await wait_for_n_done(tasks[1:], 1)
+    assert not pending
 
-        # Acquiring an amount of 3 would take 1 second
-        task = asyncio.ensure_future(limiter.acquire(3))
-        pending = await wait_for_n_done([task], 0)
-        assert pending
 
-        # _Unless_ a lower amount is acquired in-between
-        # increasing the wait time to 2 seconds
-        await limiter.acquire(1)
+async def test_cancelled_after_wake(mocked_time):
+    limiter = AsyncLimiter(1, 1)
+    await limiter.acquire()
 
-        mocked_time.current_time = 1
-        pending = await wait_for_n_done([task], 0)
-        assert pending
+    task = asyncio.create_task(limiter.acquire())
+    pending = await wait_for_n_done([task], 0)
+    assert pending
 
-        mocked_time.current_time = 2
-        pending = await wait_for_n_done([task], 1)
-        assert not pending
+    # let the waker reserve capacity for the task, then cancel the task
+    # before it gets to resume.
+    mocked_time.current_time = 1
+    for _ in range(MAX_WAIT_FOR_ITER):
+        if not limiter._waiters:
+            break
+        await asyncio.sleep(0)
+    assert not limiter._waiters and not task.done()
+    task.cancel()
 
+    pending = await wait_for_n_done([task], 1)
+    assert not pending and task.cancelled()
+    # the reserved capacity was handed back
+    assert limiter.has_capacity()
 
-async def test_task_cancelled():
-    limiter = AsyncLimiter(3, 3)
-    with MockLoopTime() as mocked_time:
-        # Fill the bucket with an amount of 1
-        await limiter.acquire(1)
 
-        # Two tasks asking for an amount of 3 would take 4 seconds
-        tasks = [asyncio.ensure_future(limiter.acquire(3)) for _ in range(2)]
-        pending = await wait_for_n_done(tasks, 0)
-        assert pending
+async def test_cancelled_waiters_compacted(mocked_time):
+    limiter = AsyncLimiter(1)
+    await limiter.acquire()
+
+    acquire = limiter.acquire
+    tasks = [asyncio.create_task(acquire()) for _ in range(250)]
+    pending = await wait_for_n_done(tasks, 0)
+    assert len(pending) == 250
+    assert len(limiter._waiters) == 250
+
+    # cancelled waiters behind the first are purged in bulk, not only
+    # once they reach the top of the heap
+    for task in tasks[1:]:
+        task.cancel()
+    pending = await wait_for_n_done(tasks, 249)
+    assert pending == {tasks[0]}
+    assert len(limiter._waiters) == 1
 
-        # But if the first one is cancelled, it should only take 1 second for
-        # the second to finish
-        tasks[0].cancel()
-        mocked_time.current_time = 1
-        pending = await wait_for_n_done(tasks[1:], 1)
-        assert not pending
+    tasks[0].cancel()
+    pending = await wait_for_n_done(tasks[:1], 1)
+    assert not pending and tasks[0].cancelled()
 
 
 def test_multiple_loops():
@@ -187,7 +272,8 @@ def test_multiple_loops():
 
     async def task():
         # ensure a task has to wait
-        tasks = [asyncio.ensure_future(limiter.acquire()) for _ in range(5)]
+        acquire = limiter.acquire
+        tasks = [asyncio.create_task(acquire()) for _ in range(5)]
         await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED, timeout=0)
 
     asyncio.run(task())